@@ -0,0 +1,150 @@
+"""
+Job records in the build documents, shared by
+the index and the snapshot job state registrars.
+
+The hub db can be MongoDB, sqlite3 or Elasticsearch,
+the latter two implement a subset of the pymongo API,
+targeted updates are only made to MongoDB collections.
+"""
+
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+
+from biothings.utils.common import merge
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+# resolved once, instead of on every timestamp.
+LOCAL_TZ = datetime.now().astimezone().tzinfo
+
+
+def is_mongo(collection):
+    return isinstance(collection, Collection)
+
+
+def push_job(collection, _id, job, max_jobs=None):
+    """
+    Append "job" to the jobs of the build document "_id",
+    on MongoDB, only the most recent "max_jobs" are kept.
+    """
+    if is_mongo(collection):
+        if max_jobs:
+            job = {"$each": [job], "$slice": -max_jobs}
+        collection.update_one({"_id": _id}, {"$push": {"jobs": job}})
+    else:  # appended as is on the other backends.
+        collection.update({"_id": _id}, {"$push": {"jobs": job}})
+
+
+def update_operators(delta, prefix=""):
+    """
+    Translate a delta document, as it would be merged into
+    a document by biothings.utils.common.merge, into the
+    arguments of MongoDB $set and $unset update operators.
+
+    Raise ValueError if the delta cannot be expressed this way:
+    keys containing "." or starting with "$" would become paths
+    and operators, and an empty dict would not be created.
+    """
+    if delta.get("__REPLACE__"):
+        raise ValueError("__REPLACE__ at the top level.")
+
+    _set, _unset = {}, {}
+    for key, value in delta.items():
+        if "." in key or key.startswith("$"):
+            raise ValueError("Invalid key: %s" % key)
+        path = prefix + key
+        if isinstance(value, dict):
+            if value.get("__REMOVE__"):
+                _unset[path] = ""
+            elif value.get("__REPLACE__"):
+                # merge() pops the marker, copy to
+                # leave the delta as provided.
+                _set[path] = merge({}, deepcopy(value))
+            elif not value:
+                raise ValueError("Empty dict: %s" % path)
+            else:
+                dset, dunset = update_operators(value, path + ".")
+                _set.update(dset)
+                _unset.update(dunset)
+        else:
+            _set[path] = value
+    return _set, _unset
+
+
+def _same_time(value, started_at):
+    # stored as an ISO string by sqlite3 and Elasticsearch,
+    # read back as a naive UTC datetime, truncated to the
+    # millisecond, from MongoDB.
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return False
+    if not isinstance(value, datetime):
+        return False
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return abs(value - started_at.astimezone()) < timedelta(milliseconds=1)
+
+
+def _find_job(jobs, started_at):
+    for job in reversed(jobs):
+        if job.get("status") == "in progress" and \
+                _same_time(job.get("step_started_at"), started_at):
+            return job
+    return jobs[-1]  # recorded without its starting time
+
+
+def finish_job(collection, _id, started_at, job, delta=None, ops=()):
+    """
+    Merge "job" into the job of the build document "_id" started
+    at "started_at", and "delta" into the build document, as done
+    by biothings.utils.common.merge. Then apply "ops", a sequence
+    of (filter, update) pairs, on MongoDB in the same round trip.
+
+    The job is located by its starting time. On MongoDB, only the
+    fields changed are updated, in place. On the other backends, or
+    when "delta" cannot be translated, the document is read, modified
+    and written back.
+    """
+    if is_mongo(collection):
+        try:
+            _set, _unset = update_operators(delta or {})
+        except ValueError:
+            pass
+        else:
+            # the fields of a job are set as a whole, the
+            # job only has those set when it is started.
+            for key, value in job.items():
+                if not isinstance(value, dict):
+                    _set["jobs.$[job]." + key] = value
+                elif value.get("__REMOVE__"):
+                    _unset["jobs.$[job]." + key] = ""
+                else:
+                    _set["jobs.$[job]." + key] = merge({}, deepcopy(value))
+
+            update = {"$set": _set}
+            if _unset:
+                update["$unset"] = _unset
+
+            result = collection.bulk_write([UpdateOne(
+                {"_id": _id}, update,
+                array_filters=[{
+                    "job.status": "in progress",
+                    "job.step_started_at": started_at
+                }]
+            ), *(UpdateOne(*op) for op in ops)], ordered=True)
+            assert result.matched_count, "Can't find build document '%s'" % _id
+            return
+
+    doc = collection.find_one({"_id": _id})
+    assert doc, "Can't find build document '%s'" % _id
+    merge(_find_job(doc["jobs"], started_at), job)
+    merge(doc, delta or {})
+    collection.replace_one({"_id": _id}, doc)
+
+    for _filter, update in ops:
+        if is_mongo(collection):
+            collection.update_one(_filter, update)
+        else:
+            collection.update(_filter, update)
@@ -13,7 +13,7 @@ from biothings import config as btconfig
 from biothings.hub import INDEXER_CATEGORY, INDEXMANAGER_CATEGORY
 from biothings.hub.databuild.backend import merge_src_build_metadata
 from biothings.utils.common import (get_class_from_classpath,
-                                    get_random_string, iter_n, traverse)
+                                    get_random_string, iter_n, merge, traverse)
 from biothings.utils.es import ESIndexer
 from biothings.utils.hub_db import get_src_build
 from biothings.utils.loggers import get_logger
@@ -5,7 +5,9 @@ from datetime import datetime
 from enum import Enum
 from types import SimpleNamespace
 
-from biothings.utils.common import timesofar, merge
+from biothings.utils.common import timesofar
+
+from .build_jobs import LOCAL_TZ, finish_job, is_mongo, push_job
 
 
 class Stage(Enum):
@@ -21,6 +23,10 @@ class Stage(Enum):
 
 class IndexJobStateRegistrar():
 
+    # only the most recent jobs are kept to bound
+    # the size of the build doc, on MongoDB.
+    max_jobs = 500
+
     def __init__(self, collection, build_name, index_name, **context):
 
         self.collection = collection
@@ -31,9 +37,27 @@ class IndexJobStateRegistrar():
 
         self.stage = Stage.READY
         self.t0 = 0
+        self.started_at = None
 
     @staticmethod
     def prune(collection):
+        if is_mongo(collection):
+            query = {"jobs.status": "in progress"}
+
+            for build in collection.find(query, {"_id": 1}):
+                logging.warning((
+                    "Found stale build '%s', "
+                    "marking index status as 'cancelled'"),
+                    build["_id"])
+
+            collection.update_many(query, {
+                "$set": {"jobs.$[job].status": "cancelled"},
+                "$unset": {"jobs.$[job].pid": ""}
+            }, array_filters=[{"job.status": "in progress"}])
+            return
+
+        # no projection nor array filters
+        # on the other hub db backends.
         for build in collection.find():
 
             dirty = False
@@ -59,19 +83,17 @@ class IndexJobStateRegistrar():
 
         self.t0 = time.time()
 
+        # identifies the job when it's done.
+        self.started_at = datetime.now(LOCAL_TZ)
+
         job = {
             "step": step,
             "status": "in progress",
-            "step_started_at": datetime.now().astimezone(),
+            "step_started_at": self.started_at,
             "pid": os.getpid(),
             **self.context
         }
-        self.collection.update(
-            {"_id": self.build_id},
-            {"$push": {
-                "jobs": job
-            }}
-        )
+        push_job(self.collection, self.build_id, job, self.max_jobs)
 
     def failed(self, error):
         def func(job, delta_build):
@@ -92,18 +114,14 @@ class IndexJobStateRegistrar():
         self.stage.at(Stage.STARTED)
         self.stage = Stage.DONE
 
-        build = self.collection.find_one({'_id': self.build_id})
-        assert build, "Can't find build document '%s'" % self.build_id
-
-        job = build["jobs"][-1]
-        job["time"] = timesofar(self.t0)
-        job["time_in_s"] = round(time.time() - self.t0, 0)
-        job.pop("pid")
-
+        job = {
+            "time": timesofar(self.t0),
+            "time_in_s": round(time.time() - self.t0, 0),
+            "pid": {"__REMOVE__": True}
+        }
         delta_build = {}
         func(job, delta_build)
-        merge(build, delta_build)
-        self.collection.replace_one({"_id": build["_id"]}, build)
+        finish_job(self.collection, self.build_id, self.started_at, job, delta_build)
 
 class PreIndexJSR(IndexJobStateRegistrar):
 
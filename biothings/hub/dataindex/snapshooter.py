@@ -1,29 +1,33 @@
 import asyncio
+import inspect
 import json
-import time
 import os
+import re
 from collections import UserDict, UserString
-from dataclasses import dataclass
+from copy import deepcopy
+from dataclasses import dataclass, field
 from datetime import datetime
-from functools import partial
+from functools import lru_cache, partial
 
 import boto3
+import botocore.exceptions
+import elasticsearch
 from biothings import config as btconfig
 from biothings.hub import SNAPSHOOTER_CATEGORY, SNAPSHOTMANAGER_CATEGORY
 from biothings.hub.databuild.buildconfig import AutoBuildConfig
-from biothings.hub.datarelease import set_pending_to_release_note
-from biothings.utils.common import merge
-from biothings.utils.hub import template_out
+from biothings.hub.datarelease import pending_to_release_note
+from biothings.utils.common import get_dotfield_value, merge
 from biothings.utils.hub_db import get_src_build
 from biothings.utils.loggers import get_logger
 from biothings.utils.manager import BaseManager
-from elasticsearch import Elasticsearch
+from elasticsearch import AsyncElasticsearch, Elasticsearch
 
 from config import logger as logging
 
 from . import snapshot_cleanup as cleaner
 from . import snapshot_registrar as registrar
 from .snapshot_repo import Repository
+from .build_jobs import LOCAL_TZ, is_mongo
 from .snapshot_task import Snapshot
 
 
@@ -50,14 +54,16 @@ class ProcessInfo():
         return pinfo
 
 
-@dataclass
+@dataclass(frozen=True)
 class CloudStorage():
     type: str
     access_key: str
     secret_key: str
     region: str = "us-west-2"
 
+    @lru_cache(maxsize=None)
     def get(self):
+        # shared by envs with the same storage.
         if self.type == "aws":
             session = boto3.Session(
                 aws_access_key_id=self.access_key,
@@ -85,10 +91,21 @@ class Bucket():
         return self.client.create_bucket(
             ACL=acl, Bucket=self.bucket,
             CreateBucketConfiguration={
-                'LocationConstraint': self.region
+                'LocationConstraint': self.client.meta.client.meta.region_name
             }
         )
 
+    # boto3 is blocking, the async variants
+    # run the requests in the default executor.
+
+    async def aexists(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.exists)
+
+    async def acreate(self, acl="private"):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(self.create, acl))
+
     def __str__(self):
         return (
             f"<Bucket {'READY' if self.exists() else 'MISSING'}"
@@ -98,6 +115,49 @@ class Bucket():
         )
 
 
+def _transient(exc):
+    # throttling and server errors, connection errors and
+    # timeouts are retried by the clients themselves.
+    if isinstance(exc, elasticsearch.TransportError):
+        status = exc.status_code  # "N/A" when not connected
+    elif isinstance(exc, botocore.exceptions.ClientError):
+        status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    else:
+        return False
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+async def _retry(func, *args, attempts=3, done=None, logger=None, **kwargs):
+    # await func(*args, **kwargs), retry transient errors
+    # with an exponential backoff up to 30s. "done", when
+    # provided, is awaited before a retry, to not repeat
+    # a request that took effect despite the error.
+    logger = logger or logging
+    for attempt in range(attempts):
+        if attempt and done and await done():
+            return None
+        try:
+            return await func(*args, **kwargs)
+        except Exception as exc:
+            if attempt + 1 >= attempts or not _transient(exc):
+                raise
+            delay = min(30, 2 ** attempt)
+            logger.warning(
+                "%s failed: %s, retrying in %ss.",
+                getattr(func, "__qualname__", func), exc, delay)
+            await asyncio.sleep(delay)
+
+
+_es_clients = {}
+
+def _get_es_client(cls, args):
+    # clients to the same cluster share their connection
+    # pools across envs, args may not be hashable.
+    key = (cls, json.dumps(args, sort_keys=True, default=repr))
+    if key not in _es_clients:
+        _es_clients[key] = cls(**args)
+    return _es_clients[key]
+
+
 class _UserString(UserString):
 
     def __str__(self):
@@ -110,6 +170,11 @@ class RenderedStr(_UserString):
     ...
 
 
+# "%(_meta.build_version)s" and "$(Y)"
+_TEMPLATE_FIELD = re.compile(r"%\((.*?)\)")
+_TEMPLATE_STAMP = re.compile(r"\$\((.*?)\)")
+
+
 class RepositoryConfig(UserDict):
     """
     {
@@ -121,6 +186,48 @@ class RepositoryConfig(UserDict):
         }
     }
     """
+    # unless configured otherwise, do not throttle the
+    # throughput to the default, conservative, 40mb per second.
+    DEFAULT_SETTINGS = {
+        "max_snapshot_bytes_per_sec": "400mb"
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._plan = None
+
+    def _compile(self):
+        # locate the templated string leaves once, along with
+        # the doc fields and timestamp formats they reference.
+        # the config is not supposed to change after that.
+        plan = []
+
+        def _walk(node, path):
+            if isinstance(node, dict):
+                items = node.items()
+            elif isinstance(node, list):
+                items = enumerate(node)
+            else:
+                if isinstance(node, str) and ("%" in node or "$(" in node):
+                    plan.append((
+                        path, node,
+                        tuple(set(_TEMPLATE_FIELD.findall(node))),
+                        tuple(set(_TEMPLATE_STAMP.findall(node)))
+                    ))
+                return
+            for key, value in items:
+                _walk(value, path + (key,))
+
+        _walk(self.data, ())
+        return plan
+
+    @property
+    def fields(self):
+        """ The doc fields, in dot notation, the templates reference. """
+        if self._plan is None:
+            self._plan = self._compile()
+        return {field for _, _, fields, _ in self._plan for field in fields}
+
     @property
     def repo(self):
         return self["name"]
@@ -140,31 +247,58 @@ class RepositoryConfig(UserDict):
         where "_meta.build_version" value is taken from doc in
         dot field notation, and the current year replaces "$(Y)".
         """
-        template = TemplateStr(json.dumps(self.data))
-        string = RenderedStr(template_out(template.data, doc or {}))
+        if self._plan is None:
+            self._plan = self._compile()
+
+        doc = doc or {}
+        now = datetime.now()
+        data = deepcopy(self.data)
+
+        for path, template, fields, stamps in self._plan:
+            string = template
+            for fmt in stamps:
+                string = string.replace(f"$({fmt})", now.strftime("%" + fmt))
+            string = string % {
+                field: get_dotfield_value(field, doc)
+                for field in fields
+            }
 
-        if "%" in string:
-            logging.error(template)
-            logging.error(string)
-            raise ValueError("Failed to template.")
+            if "%" in string:
+                logging.error(TemplateStr(template))
+                logging.error(RenderedStr(string))
+                raise ValueError("Failed to template.")
 
-        if template != string:
-            logging.debug(template)
-            logging.debug(string)
+            if template != string:
+                logging.debug(TemplateStr(template))
+                logging.debug(RenderedStr(string))
 
-        return RepositoryConfig(json.loads(string.data))
+            node = data
+            for key in path[:-1]:
+                node = node[key]
+            node[path[-1]] = string
 
+        settings = data.setdefault("settings", {})
+        for key, value in self.DEFAULT_SETTINGS.items():
+            settings.setdefault(key, value)
 
-class _SnapshotResult(UserDict):
+        return RepositoryConfig(data)
 
-    def __str__(self):
-        return f"{type(self).__name__}({str(self.data)})"
 
-class CumulativeResult(_SnapshotResult):
-    ...
+@dataclass
+class SnapshotRun():
+    """
+    The state of one snapshot, shared by its steps. Passed to
+    the step methods that accept a keyword argument "run".
+    """
+    build_doc: dict
+    logger: object  # logging.Logger, per snapshot
+    # build doc updates staged by the current step, (filter,
+    # update) pairs, written along with its success.
+    ops: list = field(default_factory=list)
 
-class StepResult(_SnapshotResult):
-    ...
+def _accepts(func, name):
+    params = inspect.signature(func).parameters.values()
+    return any(p.name == name or p.kind is p.VAR_KEYWORD for p in params)
 
 
 class SnapshotEnv():
@@ -173,82 +307,120 @@ class SnapshotEnv():
         self.job_manager = job_manager
 
         self.cloud = CloudStorage(**cloud).get()
+
+        # env-level shortcut to the repository settings,
+        # the value defined in the repository takes precedence.
+        repository = dict(repository)
+        repository["settings"] = {
+            **{key: kwargs[key] for key in (
+                "max_snapshot_bytes_per_sec",
+            ) if key in kwargs},
+            **repository.get("settings", {})
+        }
         self.repcfg = RepositoryConfig(repository)
-        self.client = Elasticsearch(**indexer["args"])
+        self.client = _get_es_client(Elasticsearch, indexer["args"])
+        self.aclient = _get_es_client(AsyncElasticsearch, indexer["args"])
 
         self.name = kwargs["name"]  # snapshot env
         self.idxenv = indexer["name"]  # indexer env
 
         self.pinfo = ProcessInfo(self.name)
         self.wtime = kwargs.get("monitor_delay", 15)
+        self.src_build = get_src_build()
+        # the log of a snapshot is in its run.logger.
+        self.logger = logging
 
     def _doc(self, index):
-        doc = get_src_build().find_one({
-            f"index.{index}.environment": self.idxenv})
+        _filter = {f"index.{index}.environment": self.idxenv}
+        if is_mongo(self.src_build):
+            # only fetch the fields the snapshot steps and the
+            # repository templates use, a build doc can be large,
+            # the other hub dbs do not support projections.
+            fields = {"_id", "target_name", *self.repcfg.fields}
+            doc = self.src_build.find_one(_filter, {
+                field: 1 for field in fields  # no path collision
+                if not any(field.startswith(f + ".") for f in fields)})
+        else:
+            doc = self.src_build.find_one(_filter)
         if not doc:  # not asso. with a build
             raise ValueError("Not a hub-managed index.")
         return doc  # TODO UNIQUENESS
 
-    def setup_log(self, index):
-        build_doc = self._doc(index)
+    def setup_log(self, index, build_doc=None):
+        build_doc = build_doc or self._doc(index)
         log_name = build_doc['target_name'] or build_doc['_id']
         log_folder = os.path.join(btconfig.LOG_FOLDER, 'build', log_name, "snapshot")
-        self.logger, _ = get_logger(index, log_folder=log_folder, force=True)
+        logger, _ = get_logger(index, log_folder=log_folder, force=True)
+        return logger
 
     def snapshot(self, index, snapshot=None):
-        self.setup_log(index)
+        # the build document is looked up once
+        # and shared by all steps of the snapshot.
+        build_doc = self._doc(index)
+        run = SnapshotRun(build_doc, self.setup_log(index, build_doc))
 
         async def _snapshot(snapshot):
-            x = CumulativeResult()
-            build_doc = self._doc(index)
-            cfg = self.repcfg.format(build_doc)
+            x = {}  # cumulative result
+            cfg = self.repcfg.format(run.build_doc)
             for step in ("pre", "snapshot", "post"):
                 state = registrar.dispatch(step)  # _TaskState Class
-                state = state(get_src_build(), build_doc.get("_id"))
-                self.logger.info(state)
+                state = state(self.src_build, run.build_doc.get("_id"))
+                run.logger.info(state)
                 state.started()
 
-                job = await self.job_manager.defer_to_thread(
-                    self.pinfo.get_pinfo(step, snapshot),
-                    partial(
-                        getattr(self, state.func),
-                        cfg, index, snapshot
-                    ))
+                run.ops = []
+                func = getattr(self, state.func)
+                # step methods overridden with the
+                # (cfg, index, snapshot) signature.
+                kwargs = {"run": run} if _accepts(func, "run") else {}
                 try:
-                    dx = await job
-                    dx = StepResult(dx)
+                    if asyncio.iscoroutinefunction(func):
+                        # io-bound, run in the event loop,
+                        # no need to occupy a thread.
+                        dx = await func(cfg, index, snapshot, **kwargs)
+                    else:
+                        job = await self.job_manager.defer_to_thread(
+                            self.pinfo.get_pinfo(step, snapshot),
+                            partial(func, cfg, index, snapshot, **kwargs))
+                        dx = await job
 
                 except Exception as exc:
-                    self.logger.exception(exc)
-                    state.failed({}, exc)
+                    run.logger.exception(exc)
+                    state.failed({}, err=str(exc))
                     raise exc
                 else:
-                    merge(x.data, dx.data)
-                    self.logger.info(dx)
-                    self.logger.info(x)
+                    merge(x, dx)
+                    run.logger.info(dx)
+                    run.logger.info(x)
                     state.succeed(
-                        {snapshot: x.data},
-                        res=dx.data
+                        {snapshot: x},
+                        ops=run.ops,
+                        res=dx
                     )
             return x
         future = asyncio.ensure_future(_snapshot(snapshot or index))
-        future.add_done_callback(self.logger.debug)
+        future.add_done_callback(run.logger.debug)
         return future
 
-    def pre_snapshot(self, cfg, index, snapshot):
+    async def pre_snapshot(self, cfg, index, snapshot, *, run):
 
         bucket = Bucket(self.cloud, cfg.bucket)
-        repo = Repository(self.client, cfg.repo)
+        repo = Repository(self.aclient, cfg.repo)
 
-        self.logger.info(bucket)
-        self.logger.info(repo)
+        bucket_exists, repo_exists = await asyncio.gather(
+            bucket.aexists(), repo.aexists())
 
-        if not repo.exists():
-            if not bucket.exists():
-                bucket.create(cfg.get("acl"))
-                self.logger.info(bucket)
-            repo.create(**cfg)
-            self.logger.info(repo)
+        run.logger.info(("Bucket", bucket.bucket, bucket_exists))
+        run.logger.info(("Repository", repo.name, repo_exists))
+
+        if not repo_exists:
+            if not bucket_exists:
+                await _retry(
+                    bucket.acreate, cfg.get("acl"),
+                    done=bucket.aexists, logger=run.logger)
+                run.logger.info(("Created", bucket.bucket))
+            await _retry(repo.create, logger=run.logger, **cfg)
+            run.logger.info(("Created", repo.name))
 
         return {
             "__REPLACE__": True,
@@ -257,32 +429,40 @@ class SnapshotEnv():
             "environment": self.name
         }
 
-    def _snapshot(self, cfg, index, snapshot):
+    async def _snapshot(self, cfg, index, snapshot, *, run):
 
         snapshot = Snapshot(
-            self.client,
+            self.aclient,
             cfg.repo,
             snapshot)
-        self.logger.info(snapshot)
+        run.logger.info(("Snapshot", snapshot.name, cfg.repo))
 
         _replace = False
-        if snapshot.exists():
-            snapshot.delete()
-            self.logger.info(snapshot)
+        if await snapshot.aexists():
+            await snapshot.delete()
+            run.logger.info(("Deleted", snapshot.name))
             _replace = True
 
+        # not idempotent, an attempt may have started the
+        # snapshot even if it failed with a server error.
         # ------------------ #
-        snapshot.create(index)
+        await _retry(
+            snapshot.create, index,
+            done=snapshot.aexists, logger=run.logger)
         # ------------------ #
 
+        # poll with an exponential backoff, capped at the monitor
+        # delay, small snapshots do not wait the full delay.
+        delay = min(self.wtime, 1)
         while True:
-            self.logger.info(snapshot)
-            state = snapshot.state()
+            state = await snapshot.astate()
+            run.logger.info((snapshot.name, state))
 
             if state == "FAILED":
                 raise ValueError(state)
             elif state == "IN_PROGRESS":
-                time.sleep(self.wtime)
+                await asyncio.sleep(delay)
+                delay = min(self.wtime, delay * 1.5)
             elif state == "SUCCESS":
                 break
             else:  # PARTIAL/MISSING/N/A
@@ -291,12 +471,13 @@ class SnapshotEnv():
         return {
             "index_name": index,
             "replaced": _replace,
-            "created_at": datetime.now().astimezone()
+            "created_at": datetime.now(LOCAL_TZ)
         }
 
-    def post_snapshot(self, cfg, index, snapshot):
-        build_id = self._doc(index)['_id']
-        set_pending_to_release_note(build_id)
+    async def post_snapshot(self, cfg, index, snapshot, *, run):
+        # set pending to release note, written
+        # along with the state of this step.
+        run.ops.append(pending_to_release_note(run.build_doc['_id']))
         return {}
 
 
@@ -331,6 +512,8 @@ class SnapshotManager(BaseManager):
             }
         },
         "monitor_delay": 15,
+        # optional, repository settings shortcut.
+        "max_snapshot_bytes_per_sec": "400mb",  # default
     }    
     """
 
@@ -374,6 +557,11 @@ class SnapshotManager(BaseManager):
 
             x = self.index_manager[dx["name"]]
             x = dict(x)  # merge into a copy
+            # merge() modifies nested dicts in place, copy
+            # those merged into, not to alter the indexer env.
+            for key, value in dx.items():
+                if isinstance(value, dict) and isinstance(x.get(key), dict):
+                    x[key] = deepcopy(x[key])
             merge(x, dx)  # <-
 
             envdict["indexer"] = x
@@ -396,6 +584,24 @@ class SnapshotManager(BaseManager):
         env = self.register[snapshot_env]
         return env.snapshot(index, snapshot)
 
+    def snapshot_many(self, snapshots, max_concurrent=8):
+        """
+        Create a snapshot for each of the (snapshot_env, index) pairs,
+        with at most "max_concurrent" snapshots running at the same time.
+        The results are in the same order, a failed snapshot has its
+        exception in place of its result.
+        """
+        semaphore = asyncio.Semaphore(max_concurrent)
+
+        async def _snapshot(snapshot_env, index):
+            async with semaphore:
+                return await self.snapshot(snapshot_env, index)
+
+        return asyncio.ensure_future(asyncio.gather(*(
+            _snapshot(snapshot_env, index)
+            for snapshot_env, index in snapshots
+        ), return_exceptions=True))
+
     def snapshot_a_build(self, build_doc):
         """
         Create a snapshot basing on the autobuild settings in the build config.
@@ -1,11 +1,14 @@
 import logging
-from datetime import datetime, timezone
+from datetime import datetime
 from time import time
 
-from biothings.utils.common import merge, timesofar
+from biothings.utils.common import timesofar
 
-# NO CONCURRENT
-# TASK SUPPORT YET
+from .build_jobs import LOCAL_TZ, finish_job, push_job
+
+# CONCURRENT TASKS ON A BUILD ARE ONLY
+# SUPPORTED ON MONGODB, THE OTHER HUB DBS
+# UPDATE THE LAST JOB OF THE BUILD DOC.
 
 _map = {
     # "pre": PreSnapshotState,
@@ -43,54 +46,47 @@ class _TaskState:
     def __init__(self, col, _id):
         self._col = col
         self._id = _id
+        self._started_at = None
 
     @classmethod
     def __init_subclass__(cls):
         _map[cls.name] = cls
 
     def started(self, **extras):
-        timestamp = datetime.now().astimezone()
-        self._col.update(
-            {"_id": self._id},
-            {
-                "$push": {
-                    "jobs": {
-                        "step": self.step,
-                        "status": "in progress",
-                        "step_started_at": timestamp,
-                        **extras,
-                    }
-                }
-            },
-        )
-
-    def _finished(self, _doc, _job):
-        doc = self._col.find_one({"_id": self._id})
-        job = doc["jobs"][-1]
-        t0 = job["step_started_at"]
-
-        # New pymongo lib version changed the default configuration value of `tz_aware` to `False` instead of `True`.
-        # Because of that the datetime value read from mongodb was not including the timezone anymore.
-        # The solution is forcing the datetime value to include the UTC timezone when it is missing.
-        # Reference: https://pymongo.readthedocs.io/en/stable/migrate-to-pymongo4.html?highlight=datetime#tz-aware-defaults-to-false
-        if not t0.tzinfo:
-            t0 = t0.replace(tzinfo=timezone.utc)
-        t0 = t0.timestamp()
-
+        # identifies the job when it's done.
+        self._started_at = datetime.now(LOCAL_TZ)
+        push_job(self._col, self._id, {
+            "step": self.step,
+            "status": "in progress",
+            "step_started_at": self._started_at,
+            **extras,
+        })
+
+    def _finished(self, dBuild, _job, ops=()):
+        t0 = self._started_at.timestamp()
+
+        job = {}
         job["time_in_s"] = round(time() - t0, 0)
         job["time"] = timesofar(t0)
+        job.update(_job)
 
-        if self.regx:
-            merge(doc, _doc)
-        merge(job, _job)
+        # nothing to register when
+        # the build delta is empty.
+        delta = None
+        if self.regx and dBuild:
+            delta = {"snapshot": dBuild}
 
-        self._col.replace_one({"_id": self._id}, doc)
+        finish_job(
+            self._col, self._id, self._started_at,
+            job, delta, ops)
 
     def failed(self, dBuild, **dJob):
-        self._finished({"snapshot": dBuild}, {"status": "failed", **dJob})
+        self._finished(dBuild, {"status": "failed", **dJob})
 
-    def succeed(self, dBuild, **dJob):
-        self._finished({"snapshot": dBuild}, {"status": "success", **dJob})
+    def succeed(self, dBuild, ops=(), **dJob):
+        # ops: build doc updates staged by the step,
+        # (filter, update) pairs, see build_jobs.finish_job.
+        self._finished(dBuild, {"status": "success", **dJob}, ops)
 
     def __str__(self):
         return f"<{type(self).__name__} {self._id}>"
@@ -1,7 +1,3 @@
-
-import elasticsearch
-
-
 class Repository():
 
     def __init__(self, client, repository):
@@ -11,23 +7,32 @@ class Repository():
         self.client = client
         self.name = repository
 
+    def _get(self):
+        # the error body is returned when not found.
+        return self.client.snapshot.get_repository(self.name, ignore=404)
+
+    @staticmethod
+    def _found(response):
+        return response.get("status") != 404
+
     def exists(self):
-        try:
-            self.client.snapshot.get_repository(self.name)
-        except elasticsearch.exceptions.NotFoundError:
-            return False
-        return True
+        return self._found(self._get())
+
+    async def aexists(self):
+        # same as above, with an
+        # AsyncElasticsearch client.
+        return self._found(await self._get())
 
     def create(self, **body):
         # https://www.elastic.co/guide/en/elasticsearch/plugins/current/repository-s3-client.html
         return self.client.snapshot.create_repository(self.name, body=body)
 
     def delete(self):
-        self.client.snapshot.delete_repository(self.name)
+        return self.client.snapshot.delete_repository(self.name)
 
     def __str__(self):
         return (
-            f"<Repository {'READY' if self.exists() else 'MISSING'}"
+            f"<Repository"
             f" name='{self.name}'"
             f" client={self.client}"
             f">"
@@ -10,16 +10,30 @@ class Snapshot():
         self.repository = Repository(client, repository)
         self.name = snapshot
 
+    def _get(self):
+        # {"snapshots": [{...}]} or {"snapshots": []} when
+        # the snapshot is missing, the error body, without
+        # "snapshots", when the repository is missing.
+        return self.client.snapshot.get(
+            self.repository.name, self.name,
+            ignore_unavailable=True, ignore=404
+        )
+
+    @staticmethod
+    def _state(response):
+        if "snapshots" in response:
+            snapshots = response["snapshots"]
+            if snapshots:  # [{...}]
+                return snapshots[0]["state"]
+            return "MISSING"
+
+        return "N/A"
+
     def exists(self):
-        if self.repository.exists():
-            return bool(self.client.snapshot.get(
-                self.repository.name, self.name,
-                ignore_unavailable=True
-            )["snapshots"])
-        return False
+        return bool(self._get().get("snapshots"))
 
     def create(self, indices):
-        self.client.snapshot.create(
+        return self.client.snapshot.create(
             self.repository.name, self.name,
             {
                 "indices": indices,
@@ -28,25 +42,24 @@ class Snapshot():
         )
 
     def state(self):
-        if self.repository.exists():
-            snapshots = self.client.snapshot.get(
-                self.repository.name, self.name,
-                ignore_unavailable=True
-            )["snapshots"]
-
-            if snapshots:  # [{...}]
-                return snapshots[0]["state"]
-            return "MISSING"
-
-        return "N/A"
+        return self._state(self._get())
 
     def delete(self):
-        self.client.snapshot.delete(
+        return self.client.snapshot.delete(
             self.repository.name, self.name)
 
+    # with an AsyncElasticsearch client, create()
+    # and delete() return awaitables, the rest are:
+
+    async def aexists(self):
+        return bool((await self._get()).get("snapshots"))
+
+    async def astate(self):
+        return self._state(await self._get())
+
     def __str__(self):
         return (
-            f"<Snapshot {self.state()}"
+            f"<Snapshot"
             f" name='{self.name}'"
             f" repository={self.repository}"
             f">"
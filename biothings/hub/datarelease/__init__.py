@@ -4,6 +4,11 @@ def set_pending_to_publish(col_name):
     src_build = get_src_build()
     src_build.update({"_id": col_name}, {"$addToSet": {"pending": "publish"}})
 
+def pending_to_release_note(col_name):
+    # the (filter, update) pair of set_pending_to_release_note,
+    # for the callers staging it with other build doc updates.
+    return {"_id": col_name}, {"$addToSet": {"pending": "release_note"}}
+
 def set_pending_to_release_note(col_name):
     src_build = get_src_build()
-    src_build.update({"_id": col_name}, {"$addToSet": {"pending": "release_note"}})
+    src_build.update(*pending_to_release_note(col_name))
@@ -0,0 +1,67 @@
+import json
+import sqlite3
+import sys
+from types import SimpleNamespace
+
+import pytest
+from pymongo.collection import Collection as PymongoCollection
+
+from biothings import config
+from biothings.utils import es, sqlite3 as hub_sqlite3
+from biothings.utils.serializer import to_json
+
+# snapshooter imports the hub config as "config",
+# as done in a hub application folder.
+sys.modules.setdefault("config", config)
+
+
+class ESDatabase:
+    """
+    In-memory stand-in of biothings.utils.es.Database,
+    documents are serialized, as they are in Elasticsearch.
+    """
+
+    def __init__(self):
+        self.docs = {}
+
+    def _exists(self, _id):
+        return _id in self.docs
+
+    def _read(self, _id):
+        return json.loads(self.docs[_id])
+
+    def _write(self, _id, doc):
+        assert doc.pop("_id", None) in (_id, None)
+        self.docs[_id] = to_json(doc)
+
+    def _modify(self, _id, func):
+        doc = self._read(_id)
+        doc = func(doc) or doc
+        self._write(_id, doc)
+
+
+@pytest.fixture
+def sqlite_collection(tmp_path):
+    db = SimpleNamespace(dbfile=str(tmp_path / "hubdb"))
+    with sqlite3.connect(db.dbfile) as conn:
+        conn.execute("CREATE TABLE src_build (_id TEXT PRIMARY KEY, document TEXT)")
+    return hub_sqlite3.Collection("src_build", db)
+
+
+@pytest.fixture
+def es_collection():
+    return es.Collection("src_build", ESDatabase())
+
+
+@pytest.fixture(params=["sqlite", "es"])
+def hubdb_collection(request):
+    """ A src_build collection of the non-MongoDB hub db backends. """
+    return request.getfixturevalue(request.param + "_collection")
+
+
+@pytest.fixture
+def mongo_collection(mocker):
+    """ Records the calls made to a pymongo collection. """
+    collection = mocker.MagicMock(spec=PymongoCollection)
+    collection.bulk_write.return_value.matched_count = 1
+    return collection
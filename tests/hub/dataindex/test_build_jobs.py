@@ -0,0 +1,212 @@
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo import UpdateOne
+
+from biothings.hub.dataindex.build_jobs import finish_job, update_operators
+from biothings.utils.common import merge
+
+
+def apply_operators(doc, _set, _unset):
+    # what mongodb does with $set and $unset.
+    for path, value in _set.items():
+        *keys, last = path.split(".")
+        node = doc
+        for key in keys:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+        node[last] = value
+    for path in _unset:
+        *keys, last = path.split(".")
+        node = doc
+        for key in keys:
+            node = node.get(key, {})
+        node.pop(last, None)
+    return doc
+
+
+@pytest.fixture
+def build_doc():
+    return {
+        "_id": "mynews_202105261855_5ffxvchx",
+        "target_name": "mynews",
+        "index": {
+            "mynews_a": {"count": 10, "environment": "local"},
+            "mynews_b": {"count": 20, "environment": "local"},
+        },
+        "snapshot": {
+            "mynews_a": {"conf": {"repository": {"name": "s3-2021"}}, "environment": "s3"}
+        },
+        "jobs": [{"step": "index", "status": "success"}],
+    }
+
+
+@pytest.mark.parametrize("delta", [
+    {"target_name": "mynews_v2"},
+    {"index": {"mynews_c": {"count": 30}}},
+    {"index": {"mynews_a": {"count": 11, "created_at": "now"}}},
+    {"index": {"mynews_b": {"__REMOVE__": True}}},
+    {"index": {"mynews_d": {"__REMOVE__": True}}},
+    {"snapshot": {"mynews_a": {"__REPLACE__": True, "environment": "s3_v2"}}},
+    {"snapshot": {"mynews_a": {"__REPLACE__": True, "conf": {"__REPLACE__": True, "x": 1}}}},
+    {"snapshot": {"mynews_b": {"__REPLACE__": True, "conf": {}}}},
+    {"jobs": [{"step": "snapshot"}]},
+])
+def test_update_operators(build_doc, delta):
+    expected = merge(deepcopy(build_doc), deepcopy(delta))
+
+    _delta = deepcopy(delta)
+    _set, _unset = update_operators(_delta)
+    assert _delta == delta  # not modified
+
+    assert apply_operators(build_doc, _set, _unset) == expected
+
+
+def test_update_operators_paths():
+    _set, _unset = update_operators({
+        "index": {
+            "mynews_a": {"count": 11},
+            "mynews_b": {"__REMOVE__": True}
+        },
+        "snapshot": {
+            "mynews_a": {"__REPLACE__": True, "environment": "s3"}
+        }
+    })
+    assert _set == {
+        "index.mynews_a.count": 11,
+        "snapshot.mynews_a": {"environment": "s3"}
+    }
+    assert _unset == {"index.mynews_b": ""}
+
+
+@pytest.mark.parametrize("delta", [
+    {"snapshot": {"mynews_2021.01": {"environment": "s3"}}},
+    {"index": {"$set": 1}},
+    {"snapshot": {"mynews_a": {}}},
+    {"__REPLACE__": True, "target_name": "mynews"},
+])
+def test_update_operators_invalid(delta):
+    with pytest.raises(ValueError):
+        update_operators(delta)
+
+
+def _in_progress(build_doc, started_at=None):
+    build_doc["jobs"].append({
+        "step": "snapshot",
+        "status": "in progress",
+        "step_started_at": started_at,
+        "pid": 123,
+    })
+    return build_doc
+
+
+def test_finish_job(hubdb_collection, build_doc):
+    hubdb_collection.insert_one(_in_progress(build_doc))
+
+    finish_job(
+        hubdb_collection, build_doc["_id"],
+        datetime.now(timezone.utc),
+        {"status": "success", "pid": {"__REMOVE__": True}},
+        {"snapshot": {"mynews_a.v2": {"environment": "s3"}}}
+    )
+
+    doc = hubdb_collection.find_one({"_id": build_doc["_id"]})
+    assert doc["jobs"][0] == {"step": "index", "status": "success"}
+    assert doc["jobs"][-1] == {"step": "snapshot", "status": "success", "step_started_at": None}
+    assert doc["snapshot"]["mynews_a.v2"] == {"environment": "s3"}
+    assert doc["snapshot"]["mynews_a"]["environment"] == "s3"
+
+
+def test_finish_job_concurrent(hubdb_collection, build_doc):
+    started_at = datetime.now(timezone.utc)
+    _in_progress(build_doc, started_at)
+    _in_progress(build_doc, started_at + timedelta(seconds=1))
+    hubdb_collection.insert_one(build_doc)
+
+    finish_job(hubdb_collection, build_doc["_id"], started_at, {"status": "failed"})
+
+    doc = hubdb_collection.find_one({"_id": build_doc["_id"]})
+    assert [job["status"] for job in doc["jobs"]] == ["success", "failed", "in progress"]
+
+
+def test_finish_job_mongo(mongo_collection):
+    started_at = datetime.now(timezone.utc)
+
+    finish_job(
+        mongo_collection, "mynews_202105261855_5ffxvchx", started_at,
+        {"status": "success", "pid": {"__REMOVE__": True}},
+        {"index": {"mynews_a": {"count": 11}}}
+    )
+
+    mongo_collection.bulk_write.assert_called_once_with([UpdateOne(
+        {"_id": "mynews_202105261855_5ffxvchx"},
+        {
+            "$set": {
+                "index.mynews_a.count": 11,
+                "jobs.$[job].status": "success"
+            },
+            "$unset": {"jobs.$[job].pid": ""}
+        },
+        array_filters=[{
+            "job.status": "in progress",
+            "job.step_started_at": started_at
+        }]
+    )], ordered=True)
+    mongo_collection.replace_one.assert_not_called()
+
+
+def test_finish_job_ops(es_collection, build_doc):
+    # sqlite3 does not support $addToSet.
+    es_collection.insert_one(_in_progress(build_doc))
+
+    finish_job(
+        es_collection, build_doc["_id"],
+        datetime.now(timezone.utc), {"status": "success"},
+        ops=[({"_id": build_doc["_id"]}, {"$addToSet": {"pending": "release_note"}})]
+    )
+
+    doc = es_collection.find_one({"_id": build_doc["_id"]})
+    assert doc["jobs"][-1]["status"] == "success"
+    assert doc["pending"] == ["release_note"]
+
+
+def test_finish_job_ops_mongo(mongo_collection):
+    started_at = datetime.now(timezone.utc)
+    pending = ({"_id": "mynews_202105261855_5ffxvchx"}, {"$addToSet": {"pending": "release_note"}})
+
+    finish_job(
+        mongo_collection, "mynews_202105261855_5ffxvchx", started_at,
+        {"status": "success"}, ops=[pending]
+    )
+
+    (requests,), _ = mongo_collection.bulk_write.call_args
+    assert requests[1:] == [UpdateOne(*pending)]
+
+
+def test_finish_job_mongo_fallback(mongo_collection, build_doc):
+    # dots in keys are not paths.
+    started_at = datetime.now(timezone.utc)
+    # read back naive, in UTC, to the millisecond.
+    stored = started_at.replace(tzinfo=None, microsecond=started_at.microsecond // 1000 * 1000)
+    _in_progress(build_doc, stored)
+    _in_progress(build_doc, stored + timedelta(seconds=1))
+    mongo_collection.find_one.return_value = build_doc
+
+    finish_job(
+        mongo_collection, build_doc["_id"], started_at,
+        {"status": "failed"},
+        {"snapshot": {"mynews_a.v2": {"environment": "s3"}}}
+    )
+
+    mongo_collection.bulk_write.assert_not_called()
+    (_filter, doc), _ = mongo_collection.replace_one.call_args
+    assert _filter == {"_id": build_doc["_id"]}
+    assert [job["status"] for job in doc["jobs"]] == ["success", "failed", "in progress"]
+    assert doc["snapshot"]["mynews_a.v2"] == {"environment": "s3"}
+
+
+def test_finish_job_missing(hubdb_collection):
+    with pytest.raises(AssertionError):
+        finish_job(hubdb_collection, "missing", datetime.now(timezone.utc), {})
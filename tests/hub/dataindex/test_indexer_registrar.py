@@ -0,0 +1,92 @@
+import os
+
+from biothings.hub.dataindex.indexer_registrar import IndexJobStateRegistrar
+
+
+def test_prune(hubdb_collection):
+    hubdb_collection.insert_one({
+        "_id": "mynews_202105261855_5ffxvchx",
+        "jobs": [
+            {"step": "index", "status": "success"},
+            {"step": "index", "status": "in progress", "pid": 123},
+        ]
+    })
+    hubdb_collection.insert_one({
+        "_id": "mynews_202105271855_0dc2d3e1",
+        "jobs": [{"step": "index", "status": "failed"}]
+    })
+
+    IndexJobStateRegistrar.prune(hubdb_collection)
+
+    assert hubdb_collection.find_one({"_id": "mynews_202105261855_5ffxvchx"})["jobs"] == [
+        {"step": "index", "status": "success"},
+        {"step": "index", "status": "cancelled"},
+    ]
+    assert hubdb_collection.find_one({"_id": "mynews_202105271855_0dc2d3e1"})["jobs"] == [
+        {"step": "index", "status": "failed"}
+    ]
+
+
+def test_prune_mongo(mongo_collection):
+    mongo_collection.find.return_value = [{"_id": "mynews_202105261855_5ffxvchx"}]
+
+    IndexJobStateRegistrar.prune(mongo_collection)
+
+    mongo_collection.update_many.assert_called_once_with(
+        {"jobs.status": "in progress"},
+        {
+            "$set": {"jobs.$[job].status": "cancelled"},
+            "$unset": {"jobs.$[job].pid": ""}
+        },
+        array_filters=[{"job.status": "in progress"}]
+    )
+    mongo_collection.replace_one.assert_not_called()
+
+
+def test_started_succeed(hubdb_collection):
+    hubdb_collection.insert_one({"_id": "mynews_202105261855_5ffxvchx", "jobs": []})
+
+    job = IndexJobStateRegistrar(
+        hubdb_collection, "mynews_202105261855_5ffxvchx",
+        "mynews_a", logfile="/log/file")
+    job.started()
+    job.succeed({"count": 10})
+
+    doc = hubdb_collection.find_one({"_id": "mynews_202105261855_5ffxvchx"})
+    assert doc["index"] == {"mynews_a": {"count": 10}}
+    assert len(doc["jobs"]) == 1
+    assert doc["jobs"][0]["step"] == "index"
+    assert doc["jobs"][0]["status"] == "success"
+    assert doc["jobs"][0]["logfile"] == "/log/file"
+    assert "pid" not in doc["jobs"][0]
+
+
+def test_started_failed(hubdb_collection):
+    hubdb_collection.insert_one({"_id": "mynews_202105261855_5ffxvchx"})
+
+    job = IndexJobStateRegistrar(
+        hubdb_collection, "mynews_202105261855_5ffxvchx", "mynews_a")
+    job.started("post-index")
+    job.failed(ValueError("MockErrorA"))
+
+    doc = hubdb_collection.find_one({"_id": "mynews_202105261855_5ffxvchx"})
+    assert "index" not in doc
+    assert doc["jobs"][0]["step"] == "post-index"
+    assert doc["jobs"][0]["status"] == "failed"
+    assert doc["jobs"][0]["err"] == "MockErrorA"
+
+
+def test_started_mongo(mongo_collection):
+    job = IndexJobStateRegistrar(
+        mongo_collection, "mynews_202105261855_5ffxvchx", "mynews_a")
+    job.started()
+
+    (_filter, update), _ = mongo_collection.update_one.call_args
+    assert _filter == {"_id": "mynews_202105261855_5ffxvchx"}
+    assert update["$push"]["jobs"]["$slice"] == -IndexJobStateRegistrar.max_jobs
+    assert update["$push"]["jobs"]["$each"] == [{
+        "step": "index",
+        "status": "in progress",
+        "step_started_at": job.started_at,
+        "pid": os.getpid()
+    }]
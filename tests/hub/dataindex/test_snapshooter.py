@@ -0,0 +1,416 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import elasticsearch
+import pytest
+from botocore.exceptions import ClientError
+from pymongo import UpdateOne
+
+from biothings.hub.dataindex import snapshooter
+from biothings.hub.datarelease import pending_to_release_note
+
+
+@pytest.fixture
+def snapshot_manager(mocker):
+    mocker.patch.object(snapshooter.SnapshotManager, "clean_stale_status")
+    mocker.patch.object(snapshooter, "SnapshotEnv")
+    index_manager = {
+        "local": {
+            "name": "local",
+            "args": {"hosts": "localhost:9200", "timeout": 100},
+        }
+    }
+    return snapshooter.SnapshotManager(index_manager, job_manager=None)
+
+
+def test_configure(snapshot_manager):
+    snapshot_manager.configure({
+        "env": {
+            "s3": {"indexer": "local"},
+            "s3_slow": {"indexer": {"name": "local", "args": {"timeout": 300}}},
+        }
+    })
+
+    assert snapshot_manager.index_manager["local"]["args"]["timeout"] == 100
+    envs = {
+        call.kwargs["name"]: call.kwargs["indexer"]
+        for call in snapshooter.SnapshotEnv.call_args_list
+    }
+    assert envs["s3"]["args"] == {"hosts": "localhost:9200", "timeout": 100}
+    assert envs["s3_slow"]["args"] == {"hosts": "localhost:9200", "timeout": 300}
+
+
+@pytest.fixture
+def repository_config():
+    return snapshooter.RepositoryConfig({
+        "type": "s3",
+        "name": "s3-$(Y)",
+        "acl": "private",
+        "settings": {
+            "bucket": "biothings-snapshots",
+            "base_path": "%(target_name)s/%(_meta.build_version)s/$(Y)",
+            "region": "us-west-2",
+            "tags": ["%(_meta.build_version)s", 1],
+        }
+    })
+
+
+def test_repository_config_fields(repository_config):
+    assert repository_config.fields == {"target_name", "_meta.build_version"}
+    assert sorted(path for path, *_ in repository_config._plan) == [
+        ("name",),
+        ("settings", "base_path"),
+        ("settings", "tags", 0),
+    ]
+
+
+def test_repository_config_format(repository_config):
+    year = datetime.now().strftime("%Y")
+    cfg = repository_config.format({
+        "target_name": "mynews",
+        "_meta": {"build_version": "20210526"}
+    })
+
+    assert isinstance(cfg, snapshooter.RepositoryConfig)
+    assert cfg.repo == f"s3-{year}"
+    assert cfg.bucket == "biothings-snapshots"
+    assert cfg["settings"]["base_path"] == f"mynews/20210526/{year}"
+    assert cfg["settings"]["tags"] == ["20210526", 1]
+    assert cfg["settings"]["max_snapshot_bytes_per_sec"] == "400mb"
+
+    # the templates are left as is.
+    assert repository_config.repo == "s3-$(Y)"
+    assert repository_config["settings"]["tags"] == ["%(_meta.build_version)s", 1]
+    assert "max_snapshot_bytes_per_sec" not in repository_config["settings"]
+
+
+def test_repository_config_format_missing(repository_config):
+    with pytest.raises(KeyError):
+        repository_config.format({"target_name": "mynews"})
+
+
+def test_snapshot_many(snapshot_manager, mocker):
+    running, peak = set(), []
+
+    async def _snapshot(index, delay):
+        running.add(index)
+        peak.append(len(running))
+        await asyncio.sleep(delay)
+        running.remove(index)
+        if index == "mynews_b":
+            raise ValueError(index)
+        return {index: {}}
+
+    def snapshot(snapshot_env, index, snapshot=None):
+        # the first ones finish last.
+        delay = {"mynews_a": 0.03, "mynews_b": 0.02}.get(index, 0.01)
+        return asyncio.ensure_future(_snapshot(index, delay))
+
+    mocker.patch.object(snapshot_manager, "snapshot", side_effect=snapshot)
+
+    async def main():
+        return await snapshot_manager.snapshot_many([
+            ("s3", "mynews_a"),
+            ("s3", "mynews_b"),
+            ("s3", "mynews_c"),
+            ("s3", "mynews_d"),
+        ], max_concurrent=2)
+
+    results = asyncio.run(main())
+
+    assert results[0] == {"mynews_a": {}}
+    assert isinstance(results[1], ValueError)
+    assert results[2:] == [{"mynews_c": {}}, {"mynews_d": {}}]
+    assert max(peak) == 2
+
+
+@pytest.mark.parametrize("exc, transient", [
+    (elasticsearch.TransportError(429, "too_many_requests"), True),
+    (elasticsearch.TransportError(503, "unavailable"), True),
+    (elasticsearch.ConnectionError("N/A", "refused", None), False),
+    (elasticsearch.TransportError(400, "invalid_snapshot_name_exception"), False),
+    (elasticsearch.NotFoundError(404, "repository_missing_exception"), False),
+    (ClientError({"ResponseMetadata": {"HTTPStatusCode": 500}}, "CreateBucket"), True),
+    (ClientError({"ResponseMetadata": {"HTTPStatusCode": 403}}, "CreateBucket"), False),
+    (ClientError({}, "CreateBucket"), False),
+    (ValueError("FAILED"), False),
+])
+def test_transient(exc, transient):
+    assert snapshooter._transient(exc) is transient
+
+
+class Calls:
+    """ An async callable, returning or raising the given values in turn. """
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    async def __call__(self, *args, **kwargs):
+        self.calls.append(args)
+        result = self.results.pop(0) if len(self.results) > 1 else self.results[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture
+def delays(mocker):
+    sleep = Calls(None)
+    mocker.patch.object(snapshooter.asyncio, "sleep", sleep)
+    return sleep.calls
+
+
+def test_retry(delays, mocker):
+    func = Calls(
+        elasticsearch.TransportError(503, "unavailable"),
+        elasticsearch.TransportError(429, "too_many_requests"),
+        {"accepted": True}
+    )
+    logger = mocker.MagicMock()
+    res = asyncio.run(snapshooter._retry(func.__call__, "mynews_a", logger=logger))
+    assert res == {"accepted": True}
+    assert func.calls == [("mynews_a",)] * 3
+    assert delays == [(1,), (2,)]
+    # logged to the snapshot log, by name.
+    warnings = [args for args, _ in logger.warning.call_args_list]
+    assert [args[1] for args in warnings] == ["Calls.__call__"] * 2
+
+
+def test_retry_exhausted(delays):
+    func = Calls(elasticsearch.TransportError(503, "unavailable"))
+    with pytest.raises(elasticsearch.TransportError):
+        asyncio.run(snapshooter._retry(func, attempts=2))
+    assert len(func.calls) == 2
+
+
+def test_retry_not_transient(delays):
+    func = Calls(elasticsearch.TransportError(400, "bad_request"))
+    with pytest.raises(elasticsearch.TransportError):
+        asyncio.run(snapshooter._retry(func))
+    assert len(func.calls) == 1
+    assert not delays
+
+
+def test_retry_done(delays):
+    # the first attempt took effect.
+    func = Calls(elasticsearch.TransportError(502, "bad_gateway"))
+    done = Calls(True)
+    assert asyncio.run(snapshooter._retry(func, done=done)) is None
+    assert len(func.calls) == 1
+    assert len(done.calls) == 1
+
+
+def test_accepts_run():
+    class Env(snapshooter.SnapshotEnv):
+        def pre_snapshot(self, cfg, index, snapshot):
+            ...
+
+        def post_snapshot(self, cfg, index, snapshot, **kwargs):
+            ...
+
+    env = Env.__new__(Env)
+    assert not snapshooter._accepts(env.pre_snapshot, "run")
+    assert snapshooter._accepts(env._snapshot, "run")
+    assert snapshooter._accepts(env.post_snapshot, "run")
+
+
+class ESSnapshots:
+    """ In-memory stand-in of the snapshot API of an AsyncElasticsearch client. """
+
+    def __init__(self):
+        self.repositories = {}
+        self.created = {}
+        # the states of the snapshots created, in turn.
+        self.states = ["SUCCESS"]
+
+    async def get_repository(self, repository, ignore=None):
+        if repository in self.repositories:
+            return {repository: self.repositories[repository]}
+        return {"error": {"type": "repository_missing_exception"}, "status": 404}
+
+    async def create_repository(self, repository, body):
+        self.repositories[repository] = body
+        return {"acknowledged": True}
+
+    async def get(self, repository, snapshot, ignore_unavailable=False, ignore=None):
+        if repository not in self.repositories:
+            return {"error": {"type": "repository_missing_exception"}, "status": 404}
+        if (repository, snapshot) not in self.created:
+            return {"snapshots": []}
+        state = self.states.pop(0) if len(self.states) > 1 else self.states[0]
+        return {"snapshots": [{"snapshot": snapshot, "state": state}]}
+
+    async def create(self, repository, snapshot, body):
+        self.created[(repository, snapshot)] = body
+        return {"accepted": True}
+
+    async def delete(self, repository, snapshot):
+        del self.created[(repository, snapshot)]
+        return {"acknowledged": True}
+
+
+class JobManager:
+    """ Runs the functions deferred to a thread in the default executor. """
+
+    def __init__(self):
+        self.pinfos = []
+
+    async def defer_to_thread(self, pinfo, func):
+        self.pinfos.append(pinfo)
+        return asyncio.get_running_loop().run_in_executor(None, func)
+
+
+@pytest.fixture
+def snapshot_env(mocker, mongo_collection):
+    mocker.patch.object(snapshooter, "CloudStorage")
+    mocker.patch.object(snapshooter, "get_logger", return_value=(mocker.MagicMock(), None))
+    mocker.patch.object(snapshooter, "get_src_build", return_value=mongo_collection)
+    mocker.patch.object(
+        snapshooter, "_get_es_client",
+        return_value=SimpleNamespace(snapshot=ESSnapshots()))
+    return snapshooter.SnapshotEnv(
+        JobManager(),
+        cloud={"type": "aws", "access_key": None, "secret_key": None},
+        repository={
+            "name": "mynews",
+            "type": "s3",
+            "settings": {"bucket": "mynews", "region": "us-west-2"},
+        },
+        indexer={"name": "local", "args": {"hosts": "localhost:9200"}},
+        name="s3",
+        monitor_delay=15,
+    )
+
+
+def test_doc(snapshot_env, es_collection):
+    # sqlite3 does not query by dotted paths.
+    es_collection.insert_one({
+        "_id": "mynews_202105261855_5ffxvchx",
+        "target_name": "mynews",
+        "index": {"mynews_a": {"environment": "local"}},
+    })
+    snapshot_env.src_build = es_collection
+
+    doc = snapshot_env._doc("mynews_a")
+    assert doc["_id"] == "mynews_202105261855_5ffxvchx"
+    with pytest.raises(ValueError):
+        snapshot_env._doc("mynews_b")
+
+
+def test_doc_mongo(snapshot_env):
+    snapshot_env.src_build.find_one.return_value = {"_id": "mynews_202105261855_5ffxvchx"}
+
+    snapshot_env._doc("mynews_a")
+    (_filter, projection), _ = snapshot_env.src_build.find_one.call_args
+    assert _filter == {"index.mynews_a.environment": "local"}
+    assert projection == {"_id": 1, "target_name": 1}
+
+
+def test_snapshot_poll(snapshot_env, delays, mocker):
+    snapshots = snapshot_env.aclient.snapshot
+    snapshots.repositories["mynews"] = {}
+    # longer than a float exponent can go.
+    snapshots.states = ["IN_PROGRESS"] * 2000 + ["SUCCESS"]
+
+    cfg = snapshot_env.repcfg.format()
+    run = snapshooter.SnapshotRun({"_id": "mynews_202105261855_5ffxvchx"}, mocker.MagicMock())
+    res = asyncio.run(snapshot_env._snapshot(cfg, "mynews_a", "mynews_a", run=run))
+
+    assert res["index_name"] == "mynews_a"
+    assert len(delays) == 2000
+    assert delays[:3] == [(1,), (1.5,), (2.25,)]
+    assert delays[-1] == (15,)
+    assert max(delay for delay, in delays) == 15
+
+
+def _snapshot(env, index):
+    env.src_build.find_one.return_value = {
+        "_id": "mynews_202105261855_5ffxvchx",
+        "target_name": "mynews",
+    }
+
+    async def snapshot():
+        return await env.snapshot(index)
+
+    return asyncio.run(snapshot())
+
+
+def _steps(src_build):
+    # the steps of the jobs started, in order.
+    return [
+        args[1]["$push"]["jobs"]["step"]
+        for args, _ in src_build.update_one.call_args_list
+    ]
+
+
+def _requests(src_build):
+    # the bulk writes of the jobs done, in order.
+    return [args[0] for args, _ in src_build.bulk_write.call_args_list]
+
+
+def test_snapshot(snapshot_env, mongo_collection, delays):
+    snapshots = snapshot_env.aclient.snapshot
+    snapshots.states = ["IN_PROGRESS", "IN_PROGRESS", "SUCCESS"]
+    snapshot_env.cloud.Bucket.return_value.creation_date = None  # missing
+
+    res = _snapshot(snapshot_env, "mynews_a")
+
+    # pre-snapshot
+    snapshot_env.cloud.create_bucket.assert_called_once()
+    assert snapshots.repositories["mynews"]["type"] == "s3"
+    # snapshot
+    assert snapshots.created == {
+        ("mynews", "mynews_a"): {"indices": "mynews_a", "include_global_state": False}
+    }
+    assert delays == [(1,), (1.5,)]
+    assert res["environment"] == "s3"
+    assert res["index_name"] == "mynews_a"
+    assert not snapshot_env.job_manager.pinfos  # all async
+
+    assert _steps(mongo_collection) == ["pre-snapshot", "snapshot", "post-snapshot"]
+    pre, main, post = _requests(mongo_collection)
+    for requests in (pre, main, post):
+        assert requests[0]._doc["$set"]["jobs.$[job].status"] == "success"
+    # only the main step registers the snapshot.
+    assert not any(path.startswith("snapshot.") for path in pre[0]._doc["$set"])
+    assert main[0]._doc["$set"]["snapshot.mynews_a.index_name"] == "mynews_a"
+    assert main[0]._doc["$set"]["snapshot.mynews_a.environment"] == "s3"
+    # staged by the step, written with its state.
+    assert pre[1:] == main[1:] == []
+    assert post[1:] == [UpdateOne(*pending_to_release_note("mynews_202105261855_5ffxvchx"))]
+
+
+def test_snapshot_sync_override(snapshot_env, mongo_collection, delays):
+    snapshot_env.aclient.snapshot.repositories["mynews"] = {}
+
+    def post_snapshot(cfg, index, snapshot):
+        return {"published": True}
+
+    snapshot_env.post_snapshot = post_snapshot
+    res = _snapshot(snapshot_env, "mynews_a")
+
+    assert res["published"] is True
+    assert [pinfo["step"] for pinfo in snapshot_env.job_manager.pinfos] == ["post:mynews_a"]
+    *_, post = _requests(mongo_collection)
+    assert post[0]._doc["$set"]["jobs.$[job].res"] == {"published": True}
+    assert post[1:] == []  # nothing staged
+
+
+@pytest.mark.parametrize("state", ["FAILED", "PARTIAL"])
+def test_snapshot_failed(snapshot_env, mongo_collection, delays, state):
+    snapshots = snapshot_env.aclient.snapshot
+    snapshots.repositories["mynews"] = {}
+    snapshots.states = ["IN_PROGRESS", state]
+
+    with pytest.raises(ValueError, match=state):
+        _snapshot(snapshot_env, "mynews_a")
+
+    assert delays == [(1,)]
+    assert _steps(mongo_collection) == ["pre-snapshot", "snapshot"]
+    _, main = _requests(mongo_collection)
+    assert main[0]._doc["$set"]["jobs.$[job].status"] == "failed"
+    assert main[0]._doc["$set"]["jobs.$[job].err"] == state
+    assert not any(path.startswith("snapshot.") for path in main[0]._doc["$set"])
+    assert main[1:] == []
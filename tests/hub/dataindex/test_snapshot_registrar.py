@@ -0,0 +1,77 @@
+from biothings.hub.dataindex.snapshot_registrar import MainSnapshotState, PreSnapshotState
+
+
+def test_succeed(hubdb_collection):
+    hubdb_collection.insert_one({"_id": "mynews_202105261855_5ffxvchx"})
+
+    state = PreSnapshotState(hubdb_collection, "mynews_202105261855_5ffxvchx")
+    state.started(logfile="/log/file")
+    state.succeed({"mynews_a": {"environment": "s3"}}, res={"environment": "s3"})
+
+    state = MainSnapshotState(hubdb_collection, "mynews_202105261855_5ffxvchx")
+    state.started()
+    state.succeed({"mynews_a": {"replaced": False}}, res={"replaced": False})
+
+    doc = hubdb_collection.find_one({"_id": "mynews_202105261855_5ffxvchx"})
+    # only the main step registers the snapshot.
+    assert doc["snapshot"] == {"mynews_a": {"replaced": False}}
+    assert [job["step"] for job in doc["jobs"]] == ["pre-snapshot", "snapshot"]
+    assert [job["status"] for job in doc["jobs"]] == ["success", "success"]
+    assert doc["jobs"][0]["logfile"] == "/log/file"
+    assert doc["jobs"][0]["res"] == {"environment": "s3"}
+    assert doc["jobs"][1]["res"] == {"replaced": False}
+
+
+def test_failed(hubdb_collection):
+    hubdb_collection.insert_one({"_id": "mynews_202105261855_5ffxvchx"})
+
+    state = MainSnapshotState(hubdb_collection, "mynews_202105261855_5ffxvchx")
+    state.started()
+    state.failed({}, err="__TEST_EXCEPTION__")
+
+    doc = hubdb_collection.find_one({"_id": "mynews_202105261855_5ffxvchx"})
+    assert doc["jobs"][0]["status"] == "failed"
+    assert doc["jobs"][0]["err"] == "__TEST_EXCEPTION__"
+
+
+def test_succeed_mongo(mongo_collection):
+    state = MainSnapshotState(mongo_collection, "mynews_202105261855_5ffxvchx")
+    state.started()
+
+    (_filter, update), _ = mongo_collection.update_one.call_args
+    assert _filter == {"_id": "mynews_202105261855_5ffxvchx"}
+    assert update["$push"]["jobs"]["step_started_at"] == state._started_at
+
+    state.succeed(
+        {"mynews_a": {"__REPLACE__": True, "replaced": False}},
+        res={"replaced": False})
+
+    (requests,), _ = mongo_collection.bulk_write.call_args
+    update = requests[0]._doc
+    assert update["$set"]["snapshot.mynews_a"] == {"replaced": False}
+    assert update["$set"]["jobs.$[job].status"] == "success"
+    assert update["$set"]["jobs.$[job].res"] == {"replaced": False}
+    assert requests[0]._array_filters == [{
+        "job.status": "in progress",
+        "job.step_started_at": state._started_at
+    }]
+    mongo_collection.replace_one.assert_not_called()
+
+
+def test_failed_mongo(mongo_collection):
+    state = MainSnapshotState(mongo_collection, "mynews_202105261855_5ffxvchx")
+    state.started()
+    state.failed({}, err="__TEST_EXCEPTION__")
+
+    (requests,), _ = mongo_collection.bulk_write.call_args
+    update = requests[0]._doc
+    # no empty snapshot registered.
+    assert not any(path.startswith("snapshot") for path in update["$set"])
+    assert update["$set"]["jobs.$[job].status"] == "failed"
+    assert update["$set"]["jobs.$[job].err"] == "__TEST_EXCEPTION__"
+    assert requests[0]._array_filters == [{
+        "job.status": "in progress",
+        "job.step_started_at": state._started_at
+    }]
+    mongo_collection.find_one.assert_not_called()
+    mongo_collection.replace_one.assert_not_called()